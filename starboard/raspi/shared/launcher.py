@@ -14,16 +14,19 @@
 # limitations under the License.
 """Raspi implementation of Starboard launcher abstraction."""
 
+import codecs
 import functools
+import itertools
 import logging
 import os
+import random
 import re
 import signal
-import six
 import sys
 import threading
 import time
 import contextlib
+import types
 
 import pexpect
 from starboard.tools import abstract_launcher
@@ -31,6 +34,9 @@ from starboard.shared import retry
 
 IS_MODULAR_BUILD = os.getenv('MODULAR_BUILD', '0') == '1'
 
+# Escapes command line metacharacters in the test flags.
+_FLAG_ESCAPE_TABLE = str.maketrans({c: '\\' + c for c in '()[]{}%!^"<>&|'})
+
 
 class TargetPathError(ValueError):
   pass
@@ -49,13 +55,95 @@ def _sigint_or_sigterm_handler(signum, frame):
   sys.exit(signum)
 
 
+_signal_handler_installs = itertools.count()
+
+
+def _install_signal_handlers():
+  """Installs the SIGINT and SIGTERM handlers once per process.
+
+  Signal handlers are process wide and can only be set from the main thread,
+  so launchers constructed on other threads rely on the main thread's
+  handlers instead.
+  """
+  if threading.current_thread() is not threading.main_thread():
+    return
+  if next(_signal_handler_installs) == 0:
+    signal.signal(signal.SIGINT, _sigint_or_sigterm_handler)
+    signal.signal(signal.SIGTERM, _sigint_or_sigterm_handler)
+
+
+class _JitteredBackoff(object):
+  """Retry backoff with exponential delay and full jitter.
+
+  Parallel launchers retrying against the same device wait for a random
+  fraction of an exponentially growing window, so they do not reconnect in
+  lockstep. Create one per retry loop so the attempt count starts over for
+  every guarded call.
+
+  |wait| is called with the delay and returns whether to stop retrying, so a
+  launcher shutdown can end both the wait and the retry loop. The window starts
+  at |initial| seconds and doubles on every attempt up to |maximum| seconds.
+  """
+
+  def __init__(self, wait, initial, maximum):
+    self._wait = wait
+    self._initial = initial
+    self._maximum = maximum
+    self._attempt = 0
+
+  def __call__(self):
+    self._attempt += 1
+    delay = min(self._maximum, self._initial * 2**(self._attempt - 1))
+    return self._wait(random.uniform(0, delay))
+
+
+class _BytesLogfile(object):
+  """Adapts a text output file to the bytes logged by pexpect.
+
+  Output is copied to the file's underlying binary buffer when it has one,
+  so the ssh stream is never decoded. Other files get an incremental UTF-8
+  decode, which copes with multibyte characters split across reads.
+  """
+
+  def __init__(self, output_file):
+    self._file = output_file
+    self._buffer = getattr(output_file, 'buffer', None)
+    self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+  def write(self, data):
+    if self._buffer is not None:
+      self._buffer.write(data)
+    else:
+      self._file.write(self._decoder.decode(data))
+
+  def flush(self):
+    self._file.flush()
+
+
+@functools.lru_cache(maxsize=512)
+def _resolve_test_path(out_directory, target_name):
+  """Returns the install path of |target_name| and whether it is a file."""
+  # TODO(b/218889313): This should reference the bin/ subdir when that's
+  # used.
+  test_path = os.path.join(out_directory, 'install', target_name, target_name)
+  return test_path, os.path.isfile(test_path)
+
+
+def _echo_signal_command(sentinel):
+  """Returns a shell command that prints |sentinel|.
+
+  The empty quotes split the sentinel in the typed command, so the terminal's
+  echo of that command does not match it. Only the command's output does.
+  """
+  return f"echo {sentinel[:1]}''{sentinel[1:]}"
+
+
+_first_run_counter = itertools.count()
+
+
 # First call returns True, otherwise return false.
 def first_run():
-  v = globals()
-  if 'first_run' not in v:
-    v['first_run'] = False
-    return True
-  return False
+  return next(_first_run_counter) == 0
 
 
 class Launcher(abstract_launcher.AbstractLauncher):
@@ -69,8 +157,17 @@ class Launcher(abstract_launcher.AbstractLauncher):
   _SSH_SLEEP_SIGNAL = 'cobalt-launcher-done-sleeping'
   _RASPI_PROMPT = 'pi@raspberrypi:'
 
+  _RSYNC_OPTS = '-avzLh'
+  _SSH_SUFFIX = ' TERM=dumb bash -l'
+  # Share one authenticated connection between all ssh and rsync invocations.
+  # ssh expands '~' in ControlPath from the passwd entry rather than $HOME, so
+  # the socket directory is resolved here and passed on as an absolute path.
+  _SSH_CONTROL_DIR = os.path.expanduser(os.path.join('~', '.ssh', 'control'))
+
   # pexpect times out each second to allow Kill to quickly stop a test run
   _PEXPECT_TIMEOUT = 1
+  # Bytes read from the ssh stream at a time
+  _PEXPECT_MAXREAD = 16384
 
   # SSH shell command retries
   _PEXPECT_SPAWN_RETRIES = 20
@@ -82,6 +179,10 @@ class Launcher(abstract_launcher.AbstractLauncher):
   _KILL_RETRIES = 3
 
   _PEXPECT_SHUTDOWN_SLEEP_TIME = 3
+  # Bytes requested per read when reading output in blocks
+  _PEXPECT_READ_SIZE = 65536
+  # Minimum time between flushes of the output file while reading test output
+  _OUTPUT_FLUSH_INTERVAL_SECONDS = 1
   # Time to wait after processes were killed
   _PROCESS_KILL_SLEEP_TIME = 10
 
@@ -93,9 +194,23 @@ class Launcher(abstract_launcher.AbstractLauncher):
   _PEXPECT_READLINE_TIMEOUT_MAX_RETRIES = 600
   # Delay between subsequent SSH commands
   _INTER_COMMAND_DELAY_SECONDS = 1.5
+  # Upper bound of the jittered backoff between connect and kill retries
+  _MAX_COMMAND_BACKOFF_SECONDS = 30
 
   # This is used to strip ansi color codes from pexpect output.
-  _PEXPECT_SANITIZE_LINE_RE = re.compile(r'\x1b[^m]*m')
+  _PEXPECT_SANITIZE_LINE_RE = re.compile(rb'\x1b[^m]*m')
+
+  # Patterns passed to pexpect, compiled once rather than on every expect call.
+  # Literal prompts and signals are matched with expect_exact instead.
+  _EXPECTED_PROMPTS_COMPILED = [
+      re.compile(rb'.*Are\syou\ssure.*'),  # Fingerprint verification
+      re.compile(rb'.* password:'),  # Password prompt
+      re.compile(rb'.*[a-zA-Z]+.*'),  # Any other text input
+  ]
+  _PROCKILL_COMPILED = [
+      re.compile(rb'PROCKILL:0\b'),
+      re.compile(rb'PROCKILL:[1-9]\d*'),
+  ]
 
   # Exceptions to retry
   _RETRY_EXCEPTIONS = (pexpect.TIMEOUT, pexpect.ExceptionPexpect,
@@ -104,9 +219,7 @@ class Launcher(abstract_launcher.AbstractLauncher):
   def __init__(self, platform, target_name, config, device_id, **kwargs):
     # pylint: disable=super-with-arguments
     super().__init__(platform, target_name, config, device_id, **kwargs)
-    env = os.environ.copy()
-    env.update(self.env_variables)
-    self.full_env = env
+    self._full_env = None
 
     if not self.device_id:
       self.device_id = self.full_env.get('RASPI_ADDR')
@@ -118,30 +231,38 @@ class Launcher(abstract_launcher.AbstractLauncher):
     self.startup_timeout_seconds = Launcher._STARTUP_TIMEOUT_SECONDS
 
     self.pexpect_process = None
+    self._pexpect_logfile = _BytesLogfile(self.output_file)
     self._InitPexpectCommands()
 
-    self.run_inactive = threading.Event()
-    self.run_inactive.set()
-
-    self.shutdown_initiated = threading.Event()
+    # Guards the run state shared with Kill(), which runs on another thread.
+    self._state_cv = threading.Condition()
+    self._shutdown = False
+    self._run_active = False
 
     self.log_targets = kwargs.get('log_targets', True)
 
-    signal.signal(signal.SIGINT, functools.partial(_sigint_or_sigterm_handler))
-    signal.signal(signal.SIGTERM, functools.partial(_sigint_or_sigterm_handler))
+    _install_signal_handlers()
 
     self.last_run_pexpect_cmd = ''
 
-  def _GetAndCheckTestFile(self, target_name):
-    # TODO(b/218889313): This should reference the bin/ subdir when that's
-    # used.
-    test_dir = os.path.join(self.out_directory, 'install', target_name)
-    test_file = target_name
-    test_path = os.path.join(test_dir, test_file)
+  @property
+  def full_env(self):
+    """Read-only process environment overlaid with the launcher's variables.
+
+    The environment is copied on first access, so launchers that never read
+    it do not keep a copy.
+    """
+    if self._full_env is None:
+      env = os.environ.copy()
+      env.update(self.env_variables)
+      self._full_env = types.MappingProxyType(env)
+    return self._full_env
 
-    if not os.path.isfile(test_path):
+  def _GetAndCheckTestFile(self, target_name):
+    test_path, exists = _resolve_test_path(self.out_directory, target_name)
+    if not exists:
       raise TargetPathError(f'TargetPath ({test_path}) must be a file.')
-    return test_file
+    return target_name
 
   def _GetAndCheckTestFileWithFallback(self):
     try:
@@ -158,74 +279,117 @@ class Launcher(abstract_launcher.AbstractLauncher):
     self.out_directory = self.out_directory.rstrip('/')
 
     test_file = self._GetAndCheckTestFileWithFallback()
+    command_args = (self.out_directory, self.device_id, test_file,
+                    ' '.join(self.target_command_line_params))
+    self.rsync_command, self.ssh_command, test_base_command = (
+        Launcher._BuildCommands(*command_args, Launcher._SSH_CONTROL_DIR))
+    # Used instead when the ssh control socket directory cannot be created
+    self._unshared_rsync_command, self._unshared_ssh_command, _ = (
+        Launcher._BuildCommands(*command_args, None))
+
+    # test output tags
+    self.test_complete_tag = f'TEST-{time.monotonic_ns():x}-{os.getpid():x}'
+    self.test_success_tag = 'succeeded'
+    self.test_failure_tag = 'failed'
+    # pexpect runs in bytes mode, so output is matched against encoded tags
+    self._test_complete_tag_b = self.test_complete_tag.encode()
+    self._test_success_tag_b = self.test_success_tag.encode()
+
+    # test command setup
+    test_success_output = (f' && echo {self.test_complete_tag} '
+                           f'{self.test_success_tag}')
+    test_failure_output = (f' || echo {self.test_complete_tag} '
+                           f'{self.test_failure_tag}')
+    self.test_command = (f'{test_base_command} {test_success_output} '
+                         f'{test_failure_output}')
+
+  @staticmethod
+  @functools.lru_cache(maxsize=512)
+  def _BuildCommands(out_directory, device_id, test_file, flags,
+                     ssh_control_dir):
+    """Returns the rsync, ssh and base test commands for a target.
 
-    raspi_user_hostname = Launcher._RASPI_USERNAME + '@' + self.device_id
+    The commands only depend on the arguments, so they are shared by
+    launchers that are reconstructed for the same target. The ssh connection
+    is shared through a socket in |ssh_control_dir| unless it is None.
+    """
+    raspi_user_hostname = f'{Launcher._RASPI_USERNAME}@{device_id}'
+    ssh_options = ''
+    if ssh_control_dir is not None:
+      # Double quotes survive being nested in rsync's single quoted -e option
+      ssh_options = (' -o ControlMaster=auto '
+                     f'-o ControlPath="{ssh_control_dir}/cobalt-%r@%h:%p" '
+                     '-o ControlPersist=60s')
 
     # Use the basename of the out directory as a common directory on the device
     # so content can be reused for several targets w/o re-syncing for each one.
-    raspi_test_dir = os.path.basename(self.out_directory)
+    raspi_test_dir = os.path.basename(out_directory)
     raspi_test_path = os.path.join(raspi_test_dir, test_file, test_file)
 
     # rsync command setup
-    options = '-avzLh'
-    source = os.path.join(self.out_directory, 'install') + '/'
+    source = os.path.join(out_directory, 'install') + '/'
     destination = f'{raspi_user_hostname}:~/{raspi_test_dir}/'
-    self.rsync_command = 'rsync ' + options + ' ' + source + ' ' + destination
+    rsync_command = (f'rsync {Launcher._RSYNC_OPTS} '
+                     f"-e 'ssh{ssh_options}' "
+                     f'{source} {destination}')
 
     # ssh command setup
-    self.ssh_command = 'ssh -t ' + raspi_user_hostname + ' TERM=dumb bash -l'
+    ssh_command = (f'ssh -t{ssh_options} '
+                   f'{raspi_user_hostname}{Launcher._SSH_SUFFIX}')
 
     # escape command line metacharacters in the flags
-    flags = ' '.join(self.target_command_line_params)
-    meta_chars = '()[]{}%!^"<>&|'
-    meta_re = re.compile('(' + '|'.join(
-        re.escape(char) for char in list(meta_chars)) + ')')
-    escaped_flags = re.subn(meta_re, r'\\\1', flags)[0]
+    escaped_flags = flags.translate(_FLAG_ESCAPE_TABLE)
+    test_base_command = f'{raspi_test_path} {escaped_flags}'
 
-    # test output tags
-    self.test_complete_tag = f'TEST-{time.time()}'
-    self.test_success_tag = 'succeeded'
-    self.test_failure_tag = 'failed'
+    return rsync_command, ssh_command, test_base_command
 
-    # test command setup
-    test_base_command = raspi_test_path + ' ' + escaped_flags
-    test_success_output = (f' && echo {self.test_complete_tag} '
-                           f'{self.test_success_tag}')
-    test_failure_output = (f' || echo {self.test_complete_tag} '
-                           f'{self.test_failure_tag}')
-    self.test_command = (f'{test_base_command} {test_success_output} '
-                         f'{test_failure_output}')
-
-  # pylint: disable=no-method-argument
-  def _CommandBackoff():
-    time.sleep(Launcher._INTER_COMMAND_DELAY_SECONDS)
+  def _WaitForShutdown(self, timeout):
+    """Waits up to |timeout| seconds. Returns whether shutdown was initiated."""
+    with self._state_cv:
+      return self._state_cv.wait_for(lambda: self._shutdown, timeout=timeout)
 
   def _ShutdownBackoff(self):
-    Launcher._CommandBackoff()
-    return self.shutdown_initiated.is_set()
+    """Waits between commands, returning early if shutdown was initiated."""
+    return self._WaitForShutdown(Launcher._INTER_COMMAND_DELAY_SECONDS)
 
-  @retry.retry(
-      exceptions=_RETRY_EXCEPTIONS,
-      retries=_PEXPECT_SPAWN_RETRIES,
-      backoff=_CommandBackoff)
-  def _PexpectSpawnAndConnect(self, command):
+  def _PexpectSpawnAndConnect(self, command, unshared_command=None):
     """Spawns a process with pexpect and connect to the raspi.
 
+    Retries with jittered backoff until connected or shutdown is initiated.
+
     Args:
        command: The command to use when spawning the pexpect process.
+       unshared_command: The command to use instead if the ssh control socket
+         directory cannot be created. Defaults to |command|.
     """
+    retry.with_retry(
+        self._SpawnAndConnect,
+        args=(command, unshared_command or command),
+        exceptions=Launcher._RETRY_EXCEPTIONS,
+        retries=Launcher._PEXPECT_SPAWN_RETRIES,
+        backoff=_JitteredBackoff(self._WaitForShutdown,
+                                 Launcher._INTER_COMMAND_DELAY_SECONDS,
+                                 Launcher._MAX_COMMAND_BACKOFF_SECONDS))
+
+  def _SpawnAndConnect(self, command, unshared_command):
+    """Makes a single attempt of _PexpectSpawnAndConnect."""
+
+    # ssh needs the directory for its ControlMaster socket. Connect without
+    # sharing the connection if it cannot be created.
+    try:
+      os.makedirs(Launcher._SSH_CONTROL_DIR, mode=0o700, exist_ok=True)
+    except OSError as e:
+      logging.warning('Not sharing ssh connections: %s', e)
+      command = unshared_command
 
     logging.info('executing: %s', command)
-    kwargs = {} if six.PY2 else {'encoding': 'utf-8'}
+    # Spawn in bytes mode so output is not decoded by pexpect
     self.pexpect_process = pexpect.spawn(
-        command, timeout=Launcher._PEXPECT_TIMEOUT, **kwargs)
+        command,
+        timeout=Launcher._PEXPECT_TIMEOUT,
+        maxread=Launcher._PEXPECT_MAXREAD)
     # Let pexpect output directly to our output stream
-    self.pexpect_process.logfile_read = self.output_file
-    expected_prompts = [
-        r'.*Are\syou\ssure.*',  # Fingerprint verification
-        r'.* password:',  # Password prompt
-        '.*[a-zA-Z]+.*',  # Any other text input
-    ]
+    self.pexpect_process.logfile_read = self._pexpect_logfile
 
     # pylint: disable=unnecessary-lambda
     @retry.retry(
@@ -234,7 +398,8 @@ class Launcher(abstract_launcher.AbstractLauncher):
         backoff=lambda: self._ShutdownBackoff(),
         wrap_exceptions=False)
     def _inner():
-      i = self.pexpect_process.expect(expected_prompts)
+      i = self.pexpect_process.expect_list(
+          Launcher._EXPECTED_PROMPTS_COMPILED)
       if i == 0:
         self._PexpectSendLine('yes')
       elif i == 1:
@@ -244,7 +409,7 @@ class Launcher(abstract_launcher.AbstractLauncher):
         # raspi does not have password. Check if we've logged in by echoing
         # a special sentence and expect it back.
         self._PexpectSendLine('echo ' + Launcher._SSH_LOGIN_SIGNAL)
-        i = self.pexpect_process.expect([Launcher._SSH_LOGIN_SIGNAL])
+        i = self.pexpect_process.expect_exact([Launcher._SSH_LOGIN_SIGNAL])
 
     _inner()
 
@@ -259,49 +424,127 @@ class Launcher(abstract_launcher.AbstractLauncher):
     self.pexpect_process.sendline(cmd)
 
   def _PexpectReadLines(self):
-    """Reads all lines from the pexpect process."""
-    while True:
-      # pylint: disable=unnecessary-lambda
-      line = retry.with_retry(
-          self.pexpect_process.readline,
-          exceptions=Launcher._RETRY_EXCEPTIONS,
-          retries=Launcher._PEXPECT_READLINE_TIMEOUT_MAX_RETRIES,
-          backoff=lambda: self.shutdown_initiated.is_set(),
-          wrap_exceptions=False)
-      # Sanitize the line to remove ansi color codes.
-      line = Launcher._PEXPECT_SANITIZE_LINE_RE.sub('', line)
+    """Reads all lines from the pexpect process.
+
+    Output is read in blocks rather than byte by byte, and blocks are only
+    split into lines when they contain the test complete tag.
+    """
+    sanitize = Launcher._PEXPECT_SANITIZE_LINE_RE.sub
+    complete_tag = self._test_complete_tag_b
+    # Start with any output left in pexpect's buffer by earlier expect calls.
+    data = self.pexpect_process.buffer
+    self.pexpect_process.buffer = b''
+    eof = False
+    # Throttle flushes so the output can still be tailed while it runs.
+    next_flush = time.monotonic() + Launcher._OUTPUT_FLUSH_INTERVAL_SECONDS
+    unflushed = False
+
+    def backoff():
+      nonlocal unflushed
+      # The output went quiet, so show everything read so far.
+      if unflushed:
+        self.output_file.flush()
+        unflushed = False
+      return self._shutdown
+
+    try:
+      while True:
+        if complete_tag in data:
+          lines = data.split(b'\n')
+          # Keep a trailing partial line for the next block, unless at EOF.
+          data = b'' if eof else lines.pop()
+          for line in lines:
+            # Sanitize the line to remove ansi color codes.
+            line = sanitize(b'', line)
+            # Check for the test complete tag. It will be followed by either a
+            # success or failure tag.
+            if line.startswith(complete_tag):
+              if line.find(self._test_success_tag_b) != -1:
+                self.return_value = 0
+              return
+        else:
+          data = data[data.rfind(b'\n') + 1:]
+        if eof:
+          return
+        try:
+          chunk = retry.with_retry(
+              self.pexpect_process.read_nonblocking,
+              args=(Launcher._PEXPECT_READ_SIZE, Launcher._PEXPECT_TIMEOUT),
+              exceptions=(pexpect.TIMEOUT,),
+              retries=Launcher._PEXPECT_READLINE_TIMEOUT_MAX_RETRIES,
+              backoff=backoff,
+              wrap_exceptions=False)
+        except pexpect.EOF:
+          eof = True
+          continue
+        now = time.monotonic()
+        if now >= next_flush:
+          self.output_file.flush()
+          unflushed = False
+          next_flush = now + Launcher._OUTPUT_FLUSH_INTERVAL_SECONDS
+        else:
+          unflushed = True
+        data += chunk
+    finally:
       self.output_file.flush()
-      if not line:
-        return
-      # Check for the test complete tag. It will be followed by either a
-      # success or failure tag.
-      if line.startswith(self.test_complete_tag):
-        if line.find(self.test_success_tag) != -1:
-          self.return_value = 0
+
+  def _PexpectReadUntilEOF(self):
+    """Waits for the pexpect process to exit.
+
+    Output is read in blocks and only copied to the output file through
+    logfile_read, so it is neither buffered, split into lines nor checked for
+    test tags. Like _PexpectReadLines, this fails if no output arrives for
+    _PEXPECT_READLINE_TIMEOUT_MAX_RETRIES seconds.
+    """
+    while True:
+      try:
+        retry.with_retry(
+            self.pexpect_process.read_nonblocking,
+            args=(Launcher._PEXPECT_READ_SIZE, Launcher._PEXPECT_TIMEOUT),
+            exceptions=(pexpect.TIMEOUT,),
+            retries=Launcher._PEXPECT_READLINE_TIMEOUT_MAX_RETRIES,
+            backoff=lambda: self._shutdown,
+            wrap_exceptions=False)
+      except pexpect.EOF:
         return
 
   def _Sleep(self, val):
-    self._PexpectSendLine(f'sleep {val};echo {Launcher._SSH_SLEEP_SIGNAL}')
-    self.pexpect_process.expect([Launcher._SSH_SLEEP_SIGNAL])
+    """Sleeps on the raspi, waiting once for the signal that it is done."""
+    self._PexpectSendLine(
+        f'sleep {val};{_echo_signal_command(Launcher._SSH_SLEEP_SIGNAL)}')
+    self.pexpect_process.expect_exact([Launcher._SSH_SLEEP_SIGNAL],
+                                      timeout=val + 2)
 
   def _CleanupPexpectProcess(self):
     """Closes current pexpect process."""
 
-    if self.pexpect_process is not None and self.pexpect_process.isalive():
+    if self.pexpect_process is None or not self.pexpect_process.isalive():
+      return
+    try:
       # Check if kernel logged OOM kill or any other system failure message
       if self.return_value:
         logging.info('Sending dmesg')
+        deadline = time.monotonic() + self._PEXPECT_SHUTDOWN_SLEEP_TIME
         with contextlib.suppress(Launcher._RETRY_EXCEPTIONS):
           self._PexpectSendLine('dmesg -P --color=never | tail -n 100')
-        time.sleep(self._PEXPECT_SHUTDOWN_SLEEP_TIME)
-        with contextlib.suppress(Launcher._RETRY_EXCEPTIONS):
-          self.pexpect_process.readlines()
+          # Output reaches the output file through logfile_read. Stop early on
+          # EOF or once no output arrives for _PEXPECT_TIMEOUT seconds.
+          remaining = deadline - time.monotonic()
+          while remaining > 0:
+            self.pexpect_process.read_nonblocking(
+                size=Launcher._PEXPECT_READ_SIZE,
+                timeout=min(Launcher._PEXPECT_TIMEOUT, remaining))
+            remaining = deadline - time.monotonic()
         logging.info('Done sending dmesg')
+        if not self.pexpect_process.isalive():
+          return
 
       # Send ctrl-c to the raspi and close the process.
       with contextlib.suppress(Launcher._RETRY_EXCEPTIONS):
         self._PexpectSendLine(chr(3))
-      time.sleep(self._PEXPECT_TIMEOUT)  # Allow time for normal shutdown
+      if self.pexpect_process.isalive():
+        time.sleep(self._PEXPECT_TIMEOUT)  # Allow time for normal shutdown
+    finally:
       with contextlib.suppress(Launcher._RETRY_EXCEPTIONS):
         self.pexpect_process.close()
 
@@ -313,16 +556,12 @@ class Launcher(abstract_launcher.AbstractLauncher):
       return self._ShutdownBackoff()
 
     retry.with_retry(
-        lambda: self.pexpect_process.expect(self._RASPI_PROMPT),
+        lambda: self.pexpect_process.expect_exact(Launcher._RASPI_PROMPT),
         exceptions=Launcher._RETRY_EXCEPTIONS,
         retries=Launcher._PROMPT_WAIT_MAX_RETRIES,
         backoff=backoff,
         wrap_exceptions=False)
 
-  @retry.retry(
-      exceptions=_RETRY_EXCEPTIONS,
-      retries=_KILL_RETRIES,
-      backoff=_CommandBackoff)
   def _KillExistingCobaltProcesses(self):
     """If there are leftover Cobalt processes, kill them.
 
@@ -330,13 +569,23 @@ class Launcher(abstract_launcher.AbstractLauncher):
     Zombie Cobalt instances can block the WebDriver port or
     cause other problems.
     """
+    retry.with_retry(
+        self._PkillCobaltProcesses,
+        exceptions=Launcher._RETRY_EXCEPTIONS,
+        retries=Launcher._KILL_RETRIES,
+        backoff=_JitteredBackoff(self._WaitForShutdown,
+                                 Launcher._INTER_COMMAND_DELAY_SECONDS,
+                                 Launcher._MAX_COMMAND_BACKOFF_SECONDS))
+
+  def _PkillCobaltProcesses(self):
+    """Makes a single attempt of _KillExistingCobaltProcesses."""
     logging.info('Killing existing processes')
+    # Print the return code of pkill in the same command. 0 if a process was
+    # halted.
     self._PexpectSendLine(
-        'pkill -9 -ef "(cobalt)|(crashpad_handler)|(elf_loader)"')
-    self._WaitForPrompt()
-    # Print the return code of pkill. 0 if a process was halted
-    self._PexpectSendLine('echo PROCKILL:${?}')
-    i = self.pexpect_process.expect([r'PROCKILL:0', r'PROCKILL:(\d+)'])
+        'pkill -9 -ef "(cobalt)|(crashpad_handler)|(elf_loader)"; '
+        'echo PROCKILL:${?}')
+    i = self.pexpect_process.expect_list(Launcher._PROCKILL_COMPILED)
     if i == 0:
       logging.warning('Forced to pkill existing instance(s) of cobalt. '
                       'Pausing to ensure no further operations are run '
@@ -360,43 +609,48 @@ class Launcher(abstract_launcher.AbstractLauncher):
 
     try:
       # Notify other threads that the run is now active
-      self.run_inactive.clear()
+      with self._state_cv:
+        self._run_active = True
 
       # rsync the test files to the raspi
-      if not self.shutdown_initiated.is_set():
-        self._PexpectSpawnAndConnect(self.rsync_command)
-      if not self.shutdown_initiated.is_set():
-        self._PexpectReadLines()
+      if not self._shutdown:
+        self._PexpectSpawnAndConnect(self.rsync_command,
+                                     self._unshared_rsync_command)
+      if not self._shutdown:
+        self._PexpectReadUntilEOF()
 
       # ssh into the raspi and run the test
-      if not self.shutdown_initiated.is_set():
-        self._PexpectSpawnAndConnect(self.ssh_command)
-        self._Sleep(self._INTER_COMMAND_DELAY_SECONDS)
+      if not self._shutdown:
+        self._PexpectSpawnAndConnect(self.ssh_command,
+                                     self._unshared_ssh_command)
+        # Give the login shell time to settle before sending commands
+        time.sleep(self._INTER_COMMAND_DELAY_SECONDS)
+        self._WaitForPrompt()
       # Execute debugging commands on the first run
       first_run_commands = []
       if self.test_result_xml_path:
         first_run_commands.append(f'touch {self.test_result_xml_path}')
       first_run_commands.extend(['free -mh', 'ps -ux', 'df -h'])
       if first_run():
-        for cmd in first_run_commands:
-          if not self.shutdown_initiated.is_set():
-            self._PexpectSendLine(cmd)
-
-            def _readline():
-              line = self.pexpect_process.readline()
-              self.output_file.write(line)
-
-            retry.with_retry(
-                _readline,
-                exceptions=Launcher._RETRY_EXCEPTIONS,
-                retries=Launcher._PROMPT_WAIT_MAX_RETRIES)
+        if not self._shutdown:
+          # Send all commands in one line to save round trips. Their output
+          # reaches the output file through logfile_read.
+          first_run_commands.append(
+              _echo_signal_command(Launcher._SSH_SLEEP_SIGNAL))
+          self._PexpectSendLine(' ; '.join(first_run_commands))
+          retry.with_retry(
+              self.pexpect_process.expect_exact,
+              args=([Launcher._SSH_SLEEP_SIGNAL],),
+              exceptions=Launcher._RETRY_EXCEPTIONS,
+              retries=Launcher._PROMPT_WAIT_MAX_RETRIES)
         self._WaitForPrompt()
         self.output_file.flush()
-        self._Sleep(self._INTER_COMMAND_DELAY_SECONDS)
+        time.sleep(self._INTER_COMMAND_DELAY_SECONDS)
         self._KillExistingCobaltProcesses()
+        # Let the device quiesce after the kill before starting the test
         self._Sleep(self._INTER_COMMAND_DELAY_SECONDS)
 
-      if not self.shutdown_initiated.is_set():
+      if not self._shutdown:
         self._PexpectSendLine(self.test_command)
         self._PexpectReadLines()
 
@@ -416,7 +670,9 @@ class Launcher(abstract_launcher.AbstractLauncher):
       self._CleanupPexpectProcess()
 
       # Notify other threads that the run is no longer active
-      self.run_inactive.set()
+      with self._state_cv:
+        self._run_active = False
+        self._state_cv.notify_all()
 
     if self.log_targets:
       logging.info('-' * 32)
@@ -429,12 +685,16 @@ class Launcher(abstract_launcher.AbstractLauncher):
     """Stops the run so that the launcher can be killed."""
 
     sys.stderr.write('\n***Killing Launcher***\n')
-    if self.run_inactive.is_set():
-      return
-    # Initiate the shutdown. This causes the run to abort within one second.
-    self.shutdown_initiated.set()
-    # Wait up to three seconds for the run to be set to inactive.
-    self.run_inactive.wait(Launcher._PEXPECT_SHUTDOWN_SLEEP_TIME)
+    with self._state_cv:
+      if not self._run_active:
+        return
+      # Initiate the shutdown. This causes the run to abort within one second.
+      self._shutdown = True
+      self._state_cv.notify_all()
+      # Wait up to three seconds for the run to be set to inactive.
+      self._state_cv.wait_for(
+          lambda: not self._run_active,
+          timeout=Launcher._PEXPECT_SHUTDOWN_SLEEP_TIME)
 
   def GetDeviceIp(self):
     """Gets the device IP."""
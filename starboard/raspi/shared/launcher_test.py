@@ -18,10 +18,14 @@ import logging
 from starboard.raspi.shared import launcher
 import sys
 import argparse
+import io
+import itertools
 import unittest
 import os
 from unittest.mock import patch, ANY, call, Mock
 import tempfile
+import threading
+import time
 from pathlib import Path
 import pexpect
 
@@ -49,6 +53,12 @@ class LauncherTest(unittest.TestCase):
         'out_directory': self.tmpdir.name
     }
     self.fake_timeout = 0.11
+    # Keep ssh control sockets out of the real home directory
+    self.ssh_control_dir = os.path.join(self.tmpdir.name, 'ssh', 'control')
+    control_dir_patcher = patch.object(launcher.Launcher, '_SSH_CONTROL_DIR',
+                                       self.ssh_control_dir)
+    control_dir_patcher.start()
+    self.addCleanup(control_dir_patcher.stop)
 
   # pylint: disable=protected-access
   def _make_launcher(self):
@@ -56,6 +66,7 @@ class LauncherTest(unittest.TestCase):
     launcher.Launcher._PEXPECT_PASSWORD_TIMEOUT_MAX_RETRIES = 0
     launcher.Launcher._PEXPECT_SHUTDOWN_SLEEP_TIME = 0.12
     launcher.Launcher._INTER_COMMAND_DELAY_SECONDS = 0.013
+    launcher.Launcher._MAX_COMMAND_BACKOFF_SECONDS = 0.05
     launcher.Launcher._PEXPECT_READLINE_TIMEOUT_MAX_RETRIES = 2
     launch = launcher.Launcher(**self.params)
     return launch
@@ -87,6 +98,54 @@ class LauncherAPITest(LauncherTest):
   def test_kill(self):
     self.assertIsNone(self._make_launcher().Kill())
 
+  @patch('starboard.raspi.shared.launcher._signal_handler_installs',
+         itertools.count())
+  @patch('starboard.raspi.shared.launcher.signal.signal')
+  def test_signal_handlers_installed_once(self, signal_):
+    thread = threading.Thread(target=self._make_launcher)
+    thread.start()
+    thread.join()
+    signal_.assert_not_called()
+
+    self._make_launcher()
+    self._make_launcher()
+    self.assertEqual(signal_.call_count, 2)
+
+  @patch.dict(os.environ, {'RASPI_ADDR': '198.51.100.2'})
+  def test_full_env(self):
+    self.params['env_variables'] = {'FOO': 'bar'}
+    launch = self._make_launcher()
+    self.assertEqual(launch.full_env['FOO'], 'bar')
+    self.assertEqual(launch.full_env['RASPI_ADDR'], '198.51.100.2')
+    with self.assertRaises(TypeError):
+      launch.full_env['FOO'] = 'baz'
+    self.assertEqual(launch.env_variables, {'FOO': 'bar'})
+
+  @patch.dict(os.environ, {'RASPI_ADDR': '198.51.100.2'})
+  def test_device_id_from_env(self):
+    self.params['device_id'] = None
+    self.assertEqual(self._make_launcher().device_id, '198.51.100.2')
+
+  def test_commands_cached(self):
+    first = self._make_launcher()
+    hits = launcher.Launcher._BuildCommands.cache_info().hits
+    second = self._make_launcher()
+    # Both the shared and the unshared connection commands are cached
+    self.assertEqual(launcher.Launcher._BuildCommands.cache_info().hits,
+                     hits + 2)
+    self.assertEqual(first.ssh_command, second.ssh_command)
+    self.assertTrue(first.ssh_command.startswith('ssh -t -o ControlMaster'))
+    self.assertTrue(
+        first.ssh_command.endswith(f'pi@{self.device_id} TERM=dumb bash -l'))
+    self.assertIn("-e 'ssh -o ControlMaster", first.rsync_command)
+    self.assertIn(f'ControlPath="{self.ssh_control_dir}/', first.rsync_command)
+    self.assertNotEqual(first.test_command, second.test_command)
+
+  def test_flags_escaped(self):
+    self.params['target_params'] = ['--url=a(b)', '--x="y|z"']
+    launch = self._make_launcher()
+    self.assertIn(r'--url=a\(b\) --x=\"y\|z\"', launch.test_command)
+
 
 class StringContains(str):
 
@@ -102,90 +161,270 @@ class LauncherInternalsTest(LauncherTest):
     super().setUp()
     self.launch = self._make_launcher()
     self.launch.pexpect_process = Mock(
-        spec_set=['expect', 'sendline', 'readline'])
+        spec_set=[
+            'buffer', 'expect', 'expect_exact', 'expect_list', 'sendline',
+            'read_nonblocking'
+        ])
+    self.launch.pexpect_process.buffer = b''
 
   @patch('starboard.raspi.shared.launcher.pexpect.spawn')
   def test_spawn(self, spawn):
     mock_pexpect = spawn.return_value
     self.launch._PexpectSpawnAndConnect('echo test')
-    spawn.assert_called_once_with('echo test', timeout=ANY, encoding=ANY)
+    spawn.assert_called_once_with('echo test', timeout=ANY, maxread=ANY)
     mock_pexpect.sendline.assert_called_once_with(
         'echo cobalt-launcher-login-success')
-    mock_pexpect.expect.assert_any_call(['cobalt-launcher-login-success'])
+    mock_pexpect.expect_exact.assert_any_call(['cobalt-launcher-login-success'])
 
   def test_sleep(self):
     self.launch._Sleep(42)
     self.launch.pexpect_process.sendline.assert_called_once_with(
-        'sleep 42;echo cobalt-launcher-done-sleeping')
-    self.launch.pexpect_process.expect.assert_called_once_with(
-        ['cobalt-launcher-done-sleeping'])
+        "sleep 42;echo c''obalt-launcher-done-sleeping")
+    self.launch.pexpect_process.expect_exact.assert_called_once_with(
+        ['cobalt-launcher-done-sleeping'], timeout=44)
+
+  def test_sleep_waits_for_output(self):
+    process = pexpect.spawn('sh', timeout=self.fake_timeout)
+    self.addCleanup(process.close)
+    self.launch.pexpect_process = process
+    start = time.monotonic()
+    self.launch._Sleep(0.3)
+    self.assertGreaterEqual(time.monotonic() - start, 0.3)
 
   def test_waitforconnect(self):
     self.launch._WaitForPrompt()
-    self.launch.pexpect_process.expect.assert_called_once_with(
+    self.launch.pexpect_process.expect_exact.assert_called_once_with(
         'pi@raspberrypi:')
 
     # trigger one timeout
-    self.launch.pexpect_process.expect = Mock(
+    self.launch.pexpect_process.expect_exact = Mock(
         side_effect=[pexpect.TIMEOUT(1), None])
     self.launch._WaitForPrompt()
-    self.launch.pexpect_process.expect.assert_has_calls([
+    self.launch.pexpect_process.expect_exact.assert_has_calls([
         call('pi@raspberrypi:'),
         call('pi@raspberrypi:'),
     ])
 
     # infinite timeout
-    self.launch.pexpect_process.expect = Mock(side_effect=pexpect.TIMEOUT(1))
+    self.launch.pexpect_process.expect_exact = Mock(
+        side_effect=pexpect.TIMEOUT(1))
     with self.assertRaises(pexpect.TIMEOUT):
       self.launch._WaitForPrompt()
 
   def test_readlines(self):
-    # Return empty string
-    self.launch.pexpect_process.readline = Mock(return_value='')
+    eof = pexpect.EOF('eof')
+    # Process exits without output
+    self.launch.pexpect_process.read_nonblocking = Mock(side_effect=eof)
     self.launch._PexpectReadLines()
-    self.launch.pexpect_process.readline.assert_called_once()
+    self.launch.pexpect_process.read_nonblocking.assert_called_once()
     self.assertIsNone(getattr(self.launch, 'return_value', None))
 
     # Return default success tag
-    self.launch.pexpect_process.readline = Mock(
-        return_value=self.launch.test_complete_tag)
+    self.launch.pexpect_process.read_nonblocking = Mock(
+        return_value=self.launch.test_complete_tag.encode() + b'\r\n')
     self.launch._PexpectReadLines()
-    self.launch.pexpect_process.readline.assert_called_once()
+    self.launch.pexpect_process.read_nonblocking.assert_called_once()
     # This is a bug
     self.assertIsNone(getattr(self.launch, 'return_value', None))
 
-    line = self.launch.test_complete_tag + self.launch.test_success_tag
-    self.launch.pexpect_process.readline = Mock(return_value=line)
+    line = (self.launch.test_complete_tag + ' ' +
+            self.launch.test_success_tag).encode()
+    self.launch.pexpect_process.read_nonblocking = Mock(
+        side_effect=[line[:8], line[8:] + b'\r\n'])
     self.launch._PexpectReadLines()
     self.assertEqual(self.launch.return_value, 0)
 
-    self.launch.pexpect_process.readline = Mock(side_effect=pexpect.TIMEOUT(1))
+    self.launch.pexpect_process.read_nonblocking = Mock(
+        side_effect=pexpect.TIMEOUT(1))
     with self.assertRaises(pexpect.TIMEOUT):
       self.launch._PexpectReadLines()
 
   def test_readlines_multiple(self):
-    self.launch.pexpect_process.readline = Mock(side_effect=['abc', 'bbc', ''])
+    eof = pexpect.EOF('eof')
+    self.launch.pexpect_process.read_nonblocking = Mock(
+        side_effect=[b'abc\r\nbb', b'c\r\n', eof])
     self.launch._PexpectReadLines()
-    self.assertEqual(3, self.launch.pexpect_process.readline.call_count)
+    self.assertEqual(3, self.launch.pexpect_process.read_nonblocking.call_count)
 
-    self.launch.pexpect_process.readline = Mock(
-        side_effect=['abc', 'bbc', '', 'none'])
+    # Tag on the last, unterminated line before EOF
+    line = (self.launch.test_complete_tag + ' ' +
+            self.launch.test_success_tag).encode()
+    self.launch.pexpect_process.read_nonblocking = Mock(
+        side_effect=[b'abc\r\n' + line, eof, b'none'])
     self.launch._PexpectReadLines()
-    self.assertEqual(3, self.launch.pexpect_process.readline.call_count)
+    self.assertEqual(2, self.launch.pexpect_process.read_nonblocking.call_count)
+    self.assertEqual(self.launch.return_value, 0)
+
+  def test_readlines_flushes_on_exit(self):
+    self.launch.output_file = Mock()
+    self.launch.pexpect_process.read_nonblocking = Mock(
+        side_effect=[b'abc\r\n', b'bbc\r\n', pexpect.EOF('eof')])
+    self.launch._PexpectReadLines()
+    self.launch.output_file.flush.assert_called_once()
+
+  def test_readlines_flushes_when_output_goes_quiet(self):
+    self.launch.output_file = Mock()
+    self.launch.pexpect_process.read_nonblocking = Mock(side_effect=[
+        b'abc\r\n',
+        pexpect.TIMEOUT(1),
+        pexpect.TIMEOUT(1),
+        pexpect.EOF('eof'),
+    ])
+    self.launch._PexpectReadLines()
+    # Once when the output went quiet, and once on exit
+    self.assertEqual(2, self.launch.output_file.flush.call_count)
+
+  def test_readlines_uses_buffered_output(self):
+    self.launch.pexpect_process.buffer = (
+        b'\x1b[0m' + self.launch.test_complete_tag.encode() + b' ' +
+        self.launch.test_success_tag.encode() + b'\r\n')
+    self.launch._PexpectReadLines()
+    self.launch.pexpect_process.read_nonblocking.assert_not_called()
+    self.assertEqual(self.launch.pexpect_process.buffer, b'')
+    self.assertEqual(self.launch.return_value, 0)
+
+  def test_read_until_eof(self):
+    eof = pexpect.EOF('eof')
+    self.launch.pexpect_process.read_nonblocking = Mock(side_effect=eof)
+    self.launch._PexpectReadUntilEOF()
+    self.launch.pexpect_process.read_nonblocking.assert_called_once()
+
+    # Timeouts between reads are retried
+    self.launch.pexpect_process.read_nonblocking = Mock(
+        side_effect=[b'sent 1 file', pexpect.TIMEOUT(1), b'\r\n', eof])
+    self.launch._PexpectReadUntilEOF()
+    self.assertEqual(4, self.launch.pexpect_process.read_nonblocking.call_count)
+
+    # Too long without output
+    self.launch.pexpect_process.read_nonblocking = Mock(
+        side_effect=pexpect.TIMEOUT(1))
+    with self.assertRaises(pexpect.TIMEOUT):
+      self.launch._PexpectReadUntilEOF()
+
+  @patch('starboard.raspi.shared.launcher.pexpect.spawn')
+  def test_spawn_shares_ssh_connection(self, spawn):
+    self.launch._PexpectSpawnAndConnect(self.launch.ssh_command,
+                                        self.launch._unshared_ssh_command)
+    spawn.assert_called_once_with(
+        StringContains('-o ControlMaster=auto'), timeout=ANY, maxread=ANY)
+    args = pexpect.split_command_line(spawn.call_args[0][0])
+    control_path = args[args.index('ControlMaster=auto') + 2]
+    self.assertTrue(control_path.startswith('ControlPath='))
+    socket_dir = os.path.dirname(control_path[len('ControlPath='):])
+    self.assertTrue(os.path.isabs(socket_dir))
+    self.assertEqual(socket_dir, self.ssh_control_dir)
+    self.assertTrue(os.path.isdir(socket_dir))
+
+  @patch('starboard.raspi.shared.launcher.pexpect.spawn')
+  @patch('starboard.raspi.shared.launcher.os.makedirs')
+  def test_spawn_without_ssh_control_dir(self, makedirs, spawn):
+    makedirs.side_effect = PermissionError('read-only')
+    self.launch._PexpectSpawnAndConnect(self.launch.rsync_command,
+                                        self.launch._unshared_rsync_command)
+    command = spawn.call_args[0][0]
+    self.assertEqual(command, self.launch._unshared_rsync_command)
+    self.assertNotIn('ControlMaster', command)
+    self.assertIn("-e 'ssh' ", command)
+
+  @patch('starboard.raspi.shared.launcher.random.uniform')
+  def test_jittered_backoff(self, uniform):
+    uniform.side_effect = lambda low, high: high
+    wait = Mock(return_value=False)
+    backoff = launcher._JitteredBackoff(wait, 0.013, 0.05)
+    for _ in range(4):
+      self.assertFalse(backoff())
+    wait.assert_has_calls([call(0.013), call(0.026), call(0.05), call(0.05)])
+    uniform.assert_called_with(0, 0.05)
+
+    # Each retry loop starts over with its own backoff
+    launcher._JitteredBackoff(wait, 0.013, 0.05)()
+    wait.assert_called_with(0.013)
+
+  def test_jittered_backoff_stops_on_shutdown(self):
+    self.launch._shutdown = True
+    backoff = launcher._JitteredBackoff(self.launch._WaitForShutdown, 0.013,
+                                        0.05)
+    self.assertTrue(backoff())
+
+  @patch('starboard.raspi.shared.launcher.pexpect.spawn')
+  def test_spawn_retries_stop_on_shutdown(self, spawn):
+    spawn.side_effect = pexpect.ExceptionPexpect('spawn failed')
+    self.launch._shutdown = True
+    with self.assertRaises(StopIteration):
+      self.launch._PexpectSpawnAndConnect('echo test')
+    spawn.assert_called_once()
+
+  def test_kill_during_run(self):
+    self.assertFalse(self.launch._ShutdownBackoff())
+    self.launch._run_active = True
+    self.launch.Kill()
+    self.assertTrue(self.launch._shutdown)
+    self.assertTrue(self.launch._ShutdownBackoff())
+
+  def test_bytes_logfile(self):
+    text_file = io.StringIO()
+    logfile = launcher._BytesLogfile(text_file)
+    data = 'caf\u00e9'.encode()
+    logfile.write(data[:-1])
+    logfile.write(data[-1:])
+    self.assertEqual(text_file.getvalue(), 'caf\u00e9')
+
+    binary_file = io.TextIOWrapper(io.BytesIO())
+    launcher._BytesLogfile(binary_file).write(data)
+    self.assertEqual(binary_file.buffer.getvalue(), data)
+
+  @patch('starboard.raspi.shared.launcher.time.sleep')
+  def test_cleanup_stops_when_process_exits(self, sleep):
+    process = Mock()
+    process.isalive = Mock(side_effect=[True, False])
+    process.read_nonblocking = Mock(side_effect=pexpect.EOF('eof'))
+    self.launch.pexpect_process = process
+    self.launch.return_value = 1
+    self.launch._CleanupPexpectProcess()
+    process.sendline.assert_called_once_with(StringContains('dmesg'))
+    process.read_nonblocking.assert_called_once()
+    sleep.assert_not_called()
+    process.close.assert_called_once()
+
+  @patch('starboard.raspi.shared.launcher.time.sleep')
+  def test_cleanup_stops_reading_when_output_goes_quiet(self, _):
+    process = Mock()
+    process.isalive = Mock(return_value=True)
+    process.read_nonblocking = Mock(
+        side_effect=[b'dmesg output\r\n', pexpect.TIMEOUT(1)])
+    self.launch.pexpect_process = process
+    self.launch.return_value = 1
+    self.launch._CleanupPexpectProcess()
+    self.assertEqual(2, process.read_nonblocking.call_count)
+    for read in process.read_nonblocking.call_args_list:
+      self.assertLessEqual(read.kwargs['timeout'], self.fake_timeout)
+    process.close.assert_called_once()
 
   def test_kill_processes(self):
     self.launch._KillExistingCobaltProcesses()
-    self.launch.pexpect_process.sendline.assert_any_call(
+    self.launch.pexpect_process.sendline.assert_called_once_with(
         StringContains('pkill'))
+    self.launch.pexpect_process.sendline.assert_called_once_with(
+        StringContains('echo PROCKILL:${?}'))
 
   @patch('starboard.raspi.shared.launcher.pexpect.spawn')
   def test_run_with_mock(self, spawn):
-    pexpect_ = Mock()
-    pexpect_.readline = Mock(return_value='')
+    pexpect_ = Mock(buffer=b'')
+    pexpect_.read_nonblocking = Mock(side_effect=pexpect.EOF('eof'))
     spawn.return_value = pexpect_
     self.launch.Run()
     self.assertEqual(self.launch.return_value, 1)
 
+  @patch('starboard.raspi.shared.launcher.first_run', return_value=True)
+  @patch('starboard.raspi.shared.launcher.pexpect.spawn')
+  def test_run_batches_first_run_commands(self, spawn, _):
+    pexpect_ = Mock(buffer=b'')
+    pexpect_.read_nonblocking = Mock(side_effect=pexpect.EOF('eof'))
+    spawn.return_value = pexpect_
+    self.launch.Run()
+    pexpect_.sendline.assert_any_call(
+        "free -mh ; ps -ux ; df -h ; echo c''obalt-launcher-done-sleeping")
+
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser()